@@ -1,17 +1,22 @@
 from qiskit.circuit import QuantumRegister, QuantumCircuit, ParameterVector
-from qiskit import QuantumCircuit, transpile
+from qiskit import QuantumCircuit, transpile, qpy
+import qiskit
+import qiskit_aer
 from qiskit_aer import Aer 
 import numpy as np
 import csv
 import math
+import functools
+import hashlib
+import inspect
 import time
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_convertion import generate_numbers
+from data_convertion import generate_numbers, counts_to_samples
 from linear_specification import PSTC_specification, MSTC_specification
-from test_oracle import OPO_UTest
-from circuit_execution import circuit_execution
+from test_oracle import OPO_UTest_batch
+from circuit_execution import circuit_execution_batch, process_pool
 from preparation_circuits import *
 from repeat_until_success import *
 
@@ -43,9 +48,69 @@ def version_selection(program_name, program_version):
         return func
     else:
         return f"Function '{function_name}' not found."
+
+def load_or_build_transpiled(program_name, program_version, n, basis, 
+                             cache_dir=os.path.join(os.path.expanduser('~'), '.cache', 'qmixedtest')):
+    '''
+        load the transpiled program version from the disk cache, or build, transpile and save it, 
+        where the file is keyed by the hash of the source code of the program version and of this 
+        function, the versions of qiskit and qiskit_aer, and the transpilation settings, so that 
+        the circuit is transpiled again once any of them changes
+
+        Input variable:
+            + program_name       [str] e.g. "LinearPauliRotations"
+            + program_version    [str] e.g. "v1", "v2", "v3"
+            + n                  [int] the number of state qubits
+            + basis              [str] the type of Pauli rotation, e.g. 'Y'
+            + cache_dir          [str] the directory of the saved circuits
+        
+        Output variable:
+            + qc_test            [QuantumCircuit] the parameterized and transpiled subroutine
+    '''
+    func = version_selection(program_name, program_version)
+    backend = Aer.get_backend('qasm_simulator')
+    optimization_level = 0
+    # the whole module of the program version is hashed, which also covers its helper functions
+    key = '\n'.join([inspect.getsource(inspect.getmodule(func)), inspect.getsource(load_or_build_transpiled), 
+                     qiskit.__version__, qiskit_aer.__version__, backend.name, str(optimization_level)])
+    source_hash = hashlib.sha1(key.encode()).hexdigest()
+    file_name = os.path.join(cache_dir, f"{program_name}_{program_version}_{n}_{basis}_{source_hash}.qpy")
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as file:
+            return qpy.load(file)[0]
+
+    params = ParameterVector('p', 2)
+    qc_test = func(n, params[0], params[1], basis)
+    qc_test = transpile(qc_test, backend, optimization_level=optimization_level)
+
+    # write to a temporary file first, so that a parallel run never loads a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(temp_name, 'wb') as file:
+        qpy.dump(qc_test, file)
+    os.replace(temp_name, file_name)
+    return qc_test
+
+@functools.lru_cache(maxsize=64)
+def transpiled_version_selection(program_name, program_version, n, basis):
+    '''
+        build and transpile the program version to be tested only once, where the slope and 
+        offset are left as parameters, i.e., p[0] -- slope, p[1] -- offset. The circuits are 
+        kept in memory, and also on the disk for the later runs
+
+        Input variable:
+            + program_name       [str] e.g. "LinearPauliRotations"
+            + program_version    [str] e.g. "v1", "v2", "v3"
+            + n                  [int] the number of state qubits
+            + basis              [str] the type of Pauli rotation, e.g. 'Y'
+        
+        Output variable:
+            + qc_test            [QuantumCircuit] the parameterized and transpiled subroutine
+    '''
+    return load_or_build_transpiled(program_name, program_version, n, basis)
         
 def testing_process_MSTCs_1MS(program_version, slop_list, offset_list, inputs_list, 
-                              mixed_pre_mode, repeats=20):
+                              mixed_pre_mode, repeats=20, seed=None, device='CPU'):
     """
         Cover a group of classical inputs with only one mixed state. For example, n = 2,
         rho = 1/4 * (|0><0| + |1><1| + |2><2| + |3><3|)
@@ -59,6 +124,8 @@ def testing_process_MSTCs_1MS(program_version, slop_list, offset_list, inputs_li
                                    input_probs -- the probability distribution of input pure states
                                    input_name -- the name of the test suite
             + mixed_pre_mode [str]: the mode for preparing mixed states, which is either 'ent' or 'sep'
+            + seed [int]: the seed of the random generator for sampling the expected distributions
+            + device [str]: the device for the simulation, which is either 'CPU' or 'GPU'
 
         Output variable:
             + recorded_result [list]: each element gives [input_name, test_cases, ave_time]  
@@ -68,61 +135,70 @@ def testing_process_MSTCs_1MS(program_version, slop_list, offset_list, inputs_li
     default_shots = 1024
     recorded_result = []      
     basis = 'Y'          # Oracle is default for Y basis 
+    backend = Aer.get_backend('qasm_simulator')
+    rng = np.random.default_rng(seed)
+    # the classical inputs as a float array, so that Aer binds them without ParameterExpression
+    slop_offset_pairs = np.array([[slop, offset] for slop in slop_list for offset in offset_list], dtype=np.float64)
 
     for inputs in inputs_list:
         n, m, angle_list, pure_states_distribution, input_name = inputs[0], inputs[1], inputs[2], inputs[3], inputs[4]
         # cover all the classical states            
-        covered_numbers = list(range(2 ** n))
+        covered_numbers = np.arange(1 << n, dtype=np.int64)
         num_classical_inputs = len(slop_list) * len(offset_list)
-        total_failures = 0
-        for _ in range(repeats):
-            test_cases = 0
-            for slop in slop_list:
-                for offset in offset_list:
-                    test_cases += 1
-                    qc = QuantumCircuit(n + m + 1, 1)
-
-                    con_pre_mode = 'sep' if m == len(angle_list) else 'ent'
-                    if con_pre_mode == 'sep':
-                        qc_con = separable_control_state_preparation(angle_list)
-                    elif con_pre_mode == 'ent':
-                        qc_con = entangled_control_state_preparation(angle_list)
-                    
-                    qc.append(qc_con, qc.qubits[:m])
-
-                    if mixed_pre_mode == 'bits':
-                        qc = bit_controlled_preparation_1MS(n, m, qc)
-                    elif mixed_pre_mode == 'qubits':
-                        qc = qubit_controlled_preparation_1MS(n, m, qc) 
-                        
-                    # append the tested quantum subroutine (quantum program) 
-                    func = version_selection(program_name, program_version)
-                    qc_test = func(n, slop, offset, basis)
-                    qc.append(qc_test, qc.qubits[m:])
-                    qc.measure(qc.qubits[-1],qc.clbits[-1])
-                    
-                    # execute the program and derive the outputs
-                    dict_counts = circuit_execution(qc, default_shots)
-
-                    # obtain the samples (measurement results) of the tested program
-                    test_samps = []
-                    for (key, value) in dict_counts.items():
-                        test_samps += [key] * value
-                    
-                    # generate the samples that follow the expected probability distribution
-                    exp_probs = MSTC_specification(covered_numbers, pure_states_distribution, slop, offset)
-                    exp_samps = list(np.random.choice(range(2 ** qc.num_clbits), size=default_shots, p=exp_probs))
-
-                    # derive the test result by nonparametric hypothesis test
-                    test_result = OPO_UTest(exp_samps, test_samps)
-                    if test_result == 'fail':
-                        total_failures += 1
+
+        qc = QuantumCircuit(n + m + 1, 1)
+
+        # prepare the control states and the mixed state
+        qc_pre = mixed_state_preparation(n, m, tuple(angle_list), mixed_pre_mode, '1MS')
+        qc.compose(qc_pre, qc.qubits[:n + m], qc.clbits[-1:], inplace=True)
+            
+        # append the tested quantum subroutine (quantum program) 
+        qc_test = transpiled_version_selection(program_name, program_version, n, basis)
+        p_slop, p_offset = qc_test.parameters
+        qc.compose(qc_test, qc.qubits[m:], inplace=True)
+        qc.measure(qc.qubits[-1],qc.clbits[-1])
+
+        # transpile once, and then only bind the classical inputs in the loops
+        executedQC = transpile(qc, backend, optimization_level=0)
+        num_outputs = 2 ** executedQC.num_clbits
+        # the samples fit into a small integer type, since only one qubit is measured
+        samps_dtype = np.min_scalar_type(num_outputs - 1)
+
+        # execute each classical input once with the shots of all the repeats in a single job, 
+        # where Aer binds all the classical inputs of the circuit
+        parameter_binds = [{p_slop: slop_offset_pairs[:, 0].tolist(), p_offset: slop_offset_pairs[:, 1].tolist()}]
+        dict_counts_iter = iter(circuit_execution_batch([executedQC], default_shots * repeats, parameter_binds, device))
+
+        # the samples of all the test cases and repeats are filled into preallocated arrays
+        exp_samps = np.empty((len(slop_offset_pairs) * repeats, default_shots), dtype=samps_dtype)
+        test_samps = np.empty_like(exp_samps)
+        test_cases = 0
+        for slop, offset in slop_offset_pairs:
+            rows = slice(test_cases * repeats, (test_cases + 1) * repeats)
+            test_cases += 1
+            
+            # derive the outputs in the same order as the bound classical inputs
+            dict_counts = next(dict_counts_iter)
+
+            # obtain the samples (measurement results) of the tested program, which are i.i.d. and
+            # thus randomly divided into the samples of the repeats
+            case_samps = test_samps[rows].reshape(-1)
+            case_samps[:] = counts_to_samples(dict_counts)
+            rng.shuffle(case_samps)
+            
+            # generate the samples that follow the expected probability distribution
+            exp_probs = MSTC_specification(covered_numbers, pure_states_distribution, slop, offset)
+            exp_samps[rows] = rng.choice(num_outputs, size=(repeats, default_shots), p=exp_probs)
+
+        # derive the test results of all the test cases and repeats by nonparametric hypothesis tests
+        test_results = OPO_UTest_batch(exp_samps, test_samps)
+        total_failures = np.count_nonzero(test_results == 'fail')
 
         recorded_result.append([input_name, test_cases, total_failures / test_cases / repeats])
     return recorded_result
 
 def testing_process_MSTCs_2MS(program_version, slop_list, offset_list, inputs_list, 
-                              mixed_pre_mode, repeats=20):
+                              mixed_pre_mode, repeats=20, seed=None, device='CPU'):
     """
         Cover a group of classical inputs with two mixed state. Given n,
         rho1 = 1/(2^(n-1)) * (|0><0| + ... + |2^{n-1}-1><2^{n-1}-1|) 
@@ -141,6 +217,8 @@ def testing_process_MSTCs_2MS(program_version, slop_list, offset_list, inputs_li
                                    pure_states_distributionss -- 2 probability distributions of input pure states
                                    input_name -- the name of the test suite
             + mixed_pre_mode [str]: the mode for preparing mixed states, which is either 'ent' or 'sep'
+            + seed [int]: the seed of the random generator for sampling the expected distributions
+            + device [str]: the device for the simulation, which is either 'CPU' or 'GPU'
 
         Output variable:
             + recorded_result [list]: each element gives [input_name, test_cases, ave_time]  
@@ -151,66 +229,96 @@ def testing_process_MSTCs_2MS(program_version, slop_list, offset_list, inputs_li
     recorded_result = []
     basis = 'Y'          # Oracle is default for Y basis       
     MSB_val_list = [0, 1]
+    backend = Aer.get_backend('qasm_simulator')
+    rng = np.random.default_rng(seed)
+    # the classical inputs as a float array, so that Aer binds them without ParameterExpression
+    slop_offset_pairs = np.array([[slop, offset] for slop in slop_list for offset in offset_list], dtype=np.float64)
+
     for inputs in inputs_list:
         n, m, angle_lists, pure_states_distributions, input_name = inputs[0], inputs[1], inputs[2], inputs[3], inputs[4]
         # cover all the classical states            
-        covered_numbers = list(range(2 ** n))
-        total_failures = 0
-        for _ in range(repeats):
-            test_cases = 0
-            for slop in slop_list:
-                for offset in offset_list:
-                    for MSB_val in MSB_val_list:
-                        test_cases += 1
-                        angle_list = angle_lists[MSB_val]
-                        pure_states_distribution = pure_states_distributions[MSB_val]
-
-                        qc = QuantumCircuit(n + m + 1, 1)
-                        
-                        # prepare the most significant qubit
-                        if MSB_val == 1:
-                            qc.x(m + n - 1)
-
-                        con_pre_mode = 'sep' if m == len(angle_list) else 'ent'
-                        if con_pre_mode == 'sep':
-                            qc_con = separable_control_state_preparation(angle_list)
-                        elif con_pre_mode == 'ent':
-                            qc_con = entangled_control_state_preparation(angle_list)
-                        
-                        qc.append(qc_con, qc.qubits[:m])
-
-                        if mixed_pre_mode == 'bits':
-                            qc = bit_controlled_preparation_2MS(n, m, qc)
-                        elif mixed_pre_mode == 'qubits':
-                            qc = qubit_controlled_preparation_2MS(n, m, qc) 
-                            
-                        # append the tested quantum subroutine (quantum program) 
-                        func = version_selection(program_name, program_version)
-                        qc_test = func(n, slop, offset, basis)
-                        qc.append(qc_test, qc.qubits[m:])
-                        qc.measure(qc.qubits[-1],qc.clbits[-1])
-                        
-                        # execute the program and derive the outputs
-                        dict_counts = circuit_execution(qc, default_shots)
-
-                        # obtain the samples (measurement results) of the tested program
-                        test_samps = []
-                        for (key, value) in dict_counts.items():
-                            test_samps += [key] * value
-                        
-                        # generate the samples that follow the expected probability distribution
-                        exp_probs = MSTC_specification(covered_numbers, pure_states_distribution, slop, offset)
-                        exp_samps = list(np.random.choice(range(2 ** qc.num_clbits), size=default_shots, p=exp_probs))
-
-                        # derive the test result by nonparametric hypothesis test
-                        test_result = OPO_UTest(exp_samps, test_samps)
-
-                        if test_result == 'fail':
-                            total_failures += 1
+        covered_numbers = np.arange(1 << n, dtype=np.int64)
+
+        # transpile the circuit of each mixed state once, and then only bind the classical inputs
+        executedQCs = {}
+        for MSB_val in MSB_val_list:
+            angle_list = angle_lists[MSB_val]
+            qc = QuantumCircuit(n + m + 1, 1)
+            
+            # prepare the most significant qubit, the control states and the mixed state
+            qc_pre = mixed_state_preparation(n, m, tuple(angle_list), mixed_pre_mode, '2MS', MSB_val)
+            qc.compose(qc_pre, qc.qubits[:n + m], qc.clbits[-1:], inplace=True)
+                
+            # append the tested quantum subroutine (quantum program) 
+            qc_test = transpiled_version_selection(program_name, program_version, n, basis)
+            p_slop, p_offset = qc_test.parameters
+            qc.compose(qc_test, qc.qubits[m:], inplace=True)
+            qc.measure(qc.qubits[-1],qc.clbits[-1])
+            executedQCs[MSB_val] = transpile(qc, backend, optimization_level=0)
+        num_outputs = 2 ** qc.num_clbits
+        # the samples fit into a small integer type, since only one qubit is measured
+        samps_dtype = np.min_scalar_type(num_outputs - 1)
+
+        # execute each classical input once with the shots of all the repeats in a single job, 
+        # where Aer binds all the classical inputs of each circuit
+        parameter_binds = [{p_slop: slop_offset_pairs[:, 0].tolist(), p_offset: slop_offset_pairs[:, 1].tolist()}
+                           for _ in MSB_val_list]
+        dict_counts_iter = iter(circuit_execution_batch([executedQCs[MSB_val] for MSB_val in MSB_val_list], 
+                                                        default_shots * repeats, parameter_binds, device))
+
+        # the samples of all the test cases and repeats are filled into preallocated arrays
+        exp_samps = np.empty((len(MSB_val_list) * len(slop_offset_pairs) * repeats, default_shots), dtype=samps_dtype)
+        test_samps = np.empty_like(exp_samps)
+        test_cases = 0
+        for MSB_val in MSB_val_list:
+            for slop, offset in slop_offset_pairs:
+                rows = slice(test_cases * repeats, (test_cases + 1) * repeats)
+                test_cases += 1
+                
+                # derive the outputs in the same order as the circuits and the bound classical inputs
+                dict_counts = next(dict_counts_iter)
+
+                # obtain the samples (measurement results) of the tested program, which are i.i.d. and
+                # thus randomly divided into the samples of the repeats
+                case_samps = test_samps[rows].reshape(-1)
+                case_samps[:] = counts_to_samples(dict_counts)
+                rng.shuffle(case_samps)
+                
+                # generate the samples that follow the expected probability distribution
+                exp_probs = MSTC_specification(covered_numbers, pure_states_distributions[MSB_val], slop, offset)
+                exp_samps[rows] = rng.choice(num_outputs, size=(repeats, default_shots), p=exp_probs)
+
+        # derive the test results of all the test cases and repeats by nonparametric hypothesis tests
+        test_results = OPO_UTest_batch(exp_samps, test_samps)
+        total_failures = np.count_nonzero(test_results == 'fail')
 
         recorded_result.append([input_name, test_cases, total_failures / test_cases / repeats])
     return recorded_result
 
+def run_one_version(program_version, slop_list, offset_list, inputs_2MS, inputs_1MS, device='CPU'):
+    '''
+        test one program version with all the test suites and save the results
+
+        Input variable:
+            + program_version    [str] e.g. "v1", "v2", "v3"
+            + inputs_2MS         [list] the test suites covered by two mixed states
+            + inputs_1MS         [list] the test suites covered by one mixed state
+            + device             [str] the device for the simulation, which is either 'CPU' or 'GPU'
+    '''
+    print(program_version)
+    recorded_result = []
+    recorded_result = recorded_result + testing_process_MSTCs_2MS(program_version, slop_list, offset_list, inputs_2MS, 'qubits', device=device)
+    recorded_result = recorded_result + testing_process_MSTCs_1MS(program_version, slop_list, offset_list, inputs_1MS, 'qubits', device=device)
+
+    # save the data
+    program_name = 'LinearPauliRotations'
+    file_name = "RQ4_" + program_name + "_" + program_version + ".csv"
+    with open(file_name, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        header = ['test_suite', '# test_cases', 'ave_fault']
+        writer.writerow(header)
+        writer.writerows(recorded_result)
+
 if __name__ == '__main__':
     # the setting to generate classical inputs
     slop_list = np.arange(-math.pi, math.pi + 1e-9, math.pi/2)
@@ -250,20 +358,12 @@ if __name__ == '__main__':
          [4*math.pi/8, math.pi/2], 
          [0.25, 0.25, 0.25, 0.25], "T7"]
     ]
-    # the test processes
-    for program_version in ["v1", "v2", "v3", "v4", "v5"]:
-        print(program_version)
-        recorded_result = []
-        recorded_result = recorded_result + testing_process_MSTCs_2MS(program_version, slop_list, offset_list, inputs_2MS, 'qubits')
-        recorded_result = recorded_result + testing_process_MSTCs_1MS(program_version, slop_list, offset_list, inputs_1MS, 'qubits')
- 
-        # save the data
-        program_name = 'LinearPauliRotations'
-        file_name = "RQ4_" + program_name + "_" + program_version + ".csv"
-        with open(file_name, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            header = ['test_suite', '# test_cases', 'ave_fault']
-            writer.writerow(header)
-            for data in recorded_result:
-                writer.writerow(data)
+    # the device for the simulation, which is either 'CPU' or 'GPU'
+    device = 'CPU'
+
+    # the test processes, where the program versions are independent and thus tested in parallel
+    versions = ["v1", "v2", "v3", "v4", "v5"]
+    with process_pool(len(versions)) as executor:
+        list(executor.map(functools.partial(run_one_version, slop_list=slop_list, offset_list=offset_list, 
+                                            inputs_2MS=inputs_2MS, inputs_1MS=inputs_1MS, device=device), versions))
     print('done!')
\ No newline at end of file
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 def PSTC_specification(number, slope, offset):
     expProbs = [0, 0]
@@ -8,9 +9,10 @@ def PSTC_specification(number, slope, offset):
     return expProbs
 
 def MSTC_specification(numbers, inputProbs, slope, offset):
-    expProbs = [0, 0]   # [p(0), p(1)]
+    # all the covered numbers are computed at once
+    numbers = np.asarray(numbers)
+    probs = np.asarray(inputProbs)[numbers]
     a, b = slope / 2, offset / 2
-    for number in numbers:
-        expProbs[0] += inputProbs[number] * math.cos(a * number + b) ** 2
-        expProbs[1] += inputProbs[number] * math.sin(a * number + b) ** 2
+    angles = a * numbers + b
+    expProbs = [np.dot(probs, np.cos(angles) ** 2), np.dot(probs, np.sin(angles) ** 2)]   # [p(0), p(1)]
     return expProbs
\ No newline at end of file
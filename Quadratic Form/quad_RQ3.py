@@ -1,4 +1,4 @@
-from qiskit.circuit import QuantumRegister, QuantumCircuit, ParameterVector
+from qiskit.circuit import QuantumRegister, QuantumCircuit, Parameter, ParameterVector
 from qiskit import QuantumCircuit, transpile
 from qiskit_aer import Aer
  
@@ -6,14 +6,16 @@ import numpy as np
 import csv
 
 import math
+import itertools
+import functools
 
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_convertion import generate_numbers
-from quad_specification import PSTC_specification, MSTC_specification
-from test_oracle import OPO_UTest
-from circuit_execution import circuit_execution
+from data_convertion import generate_numbers, counts_to_samples
+from quad_specification import PSTC_specification_batch, MSTC_specification
+from test_oracle import OPO_UTest_batch
+from circuit_execution import circuit_execution, circuit_execution_batch, process_pool
 
 from quad import QuadraticForm
 from quad_defect1 import QuadraticForm_defect1
@@ -44,55 +46,76 @@ def version_selection(program_name, program_version):
     else:
         return f"Function '{function_name}' not found."
 
-def testing_process_PSTCs(program_version, n_list, matA_dict, vecB_dict, c_list, num_out=2, repeats=20):
+def testing_process_PSTCs(program_version, n_list, matA_dict, vecB_dict, c_list, num_out=2, repeats=20, seed=None, device='CPU'):
     program_name = 'QuadraticForm'
     default_shots = 1024
     candidate_initial_states = [0, 1]
+    rng = np.random.default_rng(seed)
+    backend = Aer.get_backend('qasm_simulator')
+    func = version_selection(program_name, program_version)
+    # only the result qubits are measured, and thus the samples fit into a small integer type
+    num_outputs = 2 ** num_out
+    samps_dtype = np.min_scalar_type(num_outputs - 1)
     
     recorded_result = []      
     for n in n_list:            
-        total_failures = 0
         initial_states = generate_numbers(n, len(candidate_initial_states))
         A_list, b_list = matA_dict[n], vecB_dict[n]
-        for _ in range(repeats):
-            test_cases = 0
-            for c in c_list:
-                for A in A_list:
-                    for b in b_list:
-                        for initial_state in initial_states:
-                            test_cases += 1
-                            number = int(''.join(map(str, initial_state)), 2)
-                            qc = QuantumCircuit(n + num_out, num_out)
-                            initial_state = initial_state[::-1]
-                            
-                            for index, val in enumerate(initial_state):
-                                if candidate_initial_states[val] == 1:
-                                    qc.x(index)
-                                        
-                            # append the tested quantum subroutine (quantum program)
-                            func = version_selection(program_name, program_version)
-                            qc_test = func(num_result_qubits=num_out, quadratic=A, linear=b, offset=c)
-                            qc.append(qc_test, qc.qubits)
-                            qc.measure(qc.qubits[n:],qc.clbits[:])
-
-
-                            # execute the program and derive the outputs
-                            dict_counts = circuit_execution(qc, default_shots)
-                        
-                            # obtain the samples (measurement results) of the tested program
-                            test_samps = []
-                            for (key, value) in dict_counts.items():
-                                test_samps += [key] * value
-                        
-                            # generate the samples that follow the expected probability distribution
-                            exp_probs = PSTC_specification(initial_state, A, b, c, num_out)
-                            exp_samps = list(np.random.choice(range(2 ** qc.num_clbits), size=default_shots, p=exp_probs))                    
 
-                            # derive the test result by nonparametric hypothesis test
-                            test_result = OPO_UTest(exp_samps, test_samps)
+        # the expected probability distributions do not change over the repeats, and those of 
+        # all the initial states are computed at once for each (c, A, b)
+        reversed_states = np.array(initial_states, dtype=np.int64)[:, ::-1]
+        exp_probs_dict = {}
+        for c, (A_index, A), (b_index, b) in itertools.product(c_list, enumerate(A_list), enumerate(b_list)):
+            exp_probs_array = PSTC_specification_batch(reversed_states, A, b, c, num_out)
+            for number in range(len(initial_states)):
+                exp_probs_dict[(c, A_index, b_index, number)] = exp_probs_array[number]
+
+        # the linear coefficients and the offset are parameterized, while the quadratic coefficients are 
+        # kept as numbers since the structure of some program versions depends on their zero entries
+        params_b, param_c = ParameterVector('b', n), Parameter('c')
+        # all the repeats, linear coefficients and offsets are bound to each circuit in the same order
+        classical_inputs = [(c, b_index) for _ in range(repeats) 
+                            for c, b_index in itertools.product(c_list, range(len(b_list)))]
+        parameter_binds = {param_c: [float(c) for c, _ in classical_inputs]}
+        for j in range(n):
+            parameter_binds[params_b[j]] = [float(b_list[b_index][j]) for _, b_index in classical_inputs]
+
+        # the samples of one (A, initial state) are filled into arrays preallocated only once, 
+        # since they are scored right after each execution
+        exp_samps = np.empty((len(classical_inputs), default_shots), dtype=samps_dtype)
+        test_samps = np.empty_like(exp_samps)
+        test_cases = len(c_list) * len(A_list) * len(b_list) * len(initial_states)
+        total_failures = 0
+        for (A_index, A), (number, initial_state) in itertools.product(enumerate(A_list), enumerate(initial_states)):
+            qc = QuantumCircuit(n + num_out, num_out)
+            
+            for index, val in enumerate(initial_state[::-1]):
+                if candidate_initial_states[val] == 1:
+                    qc.x(index)
                         
-                            if test_result == 'fail':
-                                total_failures += 1   
+            # append the tested quantum subroutine (quantum program)
+            qc_test = func(num_result_qubits=num_out, quadratic=A, linear=list(params_b), offset=param_c)
+            qc.append(qc_test, qc.qubits)
+            qc.measure(qc.qubits[n:],qc.clbits[:])
+            executedQC = transpile(qc, backend, optimization_level=0)
+
+            # execute the program for all the repeats, linear coefficients and offsets in a single job
+            dict_counts_list = circuit_execution_batch([executedQC], default_shots, [parameter_binds], device)
+
+            # the samples of the job are scored right after its execution, so that only the 
+            # samples of one (A, initial state) are kept in memory
+            for row, ((c, b_index), dict_counts) in enumerate(zip(classical_inputs, dict_counts_list)):
+                # obtain the samples (measurement results) of the tested program
+                test_samps[row] = counts_to_samples(dict_counts)
+            
+                # generate the samples that follow the expected probability distribution
+                exp_probs = exp_probs_dict[(c, A_index, b_index, number)]
+                exp_samps[row] = rng.choice(num_outputs, size=default_shots, p=exp_probs)
+
+            # derive the test results of the test cases by nonparametric hypothesis tests
+            test_results = OPO_UTest_batch(exp_samps, test_samps)
+            total_failures += np.count_nonzero(test_results == 'fail')
 
         recorded_result.append([n, test_cases, total_failures / test_cases / repeats])
    
@@ -102,28 +125,39 @@ def testing_process_PSTCs(program_version, n_list, matA_dict, vecB_dict, c_list,
         writer = csv.writer(file)
         header = ['n','# test_cases', 'ave_fault']
         writer.writerow(header)
-        for data in recorded_result:
-            writer.writerow(data)
+        writer.writerows(recorded_result)
     print('PSTCs done!')
 
  
-def testing_process_MSTCs(program_version, n_list, matA_dict, vecB_dict, c_list, num_out=2, repeats=20):
+def testing_process_MSTCs(program_version, n_list, matA_dict, vecB_dict, c_list, num_out=2, repeats=20, seed=None, device='CPU'):
     program_name = 'QuadraticForm'
     default_shots = 1024
+    rng = np.random.default_rng(seed)
+    # only the result qubits are measured, and thus the samples fit into a small integer type
+    num_outputs = 2 ** num_out
+    samps_dtype = np.min_scalar_type(num_outputs - 1)
     
     recorded_result = []    
     for n in n_list:  
         # define the uniform distribution for the ensemble
         pure_states_distribution = list(np.ones(2 ** n) / (2 ** n))
         # cover all the classical states            
-        covered_numbers = list(range(2 ** n))
-        total_failures = 0
+        covered_numbers = np.arange(1 << n, dtype=np.int64)
         A_list, b_list = matA_dict[n], vecB_dict[n]
+
+        # the expected probability distributions do not change over the repeats
+        exp_probs_dict = {(c, A_index, b_index): MSTC_specification(covered_numbers, n, A, b, c, num_out, pure_states_distribution)
+                          for c in c_list for A_index, A in enumerate(A_list) for b_index, b in enumerate(b_list)}
+
+        # the samples of all the test cases and repeats are filled into preallocated arrays
+        exp_samps = np.empty((repeats * len(c_list) * len(A_list) * len(b_list), default_shots), dtype=samps_dtype)
+        test_samps = np.empty_like(exp_samps)
+        row = 0
         for _ in range(repeats):
             test_cases = 0
             for c in c_list:
-                for A in A_list:
-                    for b in b_list:
+                for A_index, A in enumerate(A_list):
+                    for b_index, b in enumerate(b_list):
                         qc = QuantumCircuit(2 * n + num_out, num_out)
                         qc.h(qc.qubits[:n])
                 
@@ -140,24 +174,21 @@ def testing_process_MSTCs(program_version, n_list, matA_dict, vecB_dict, c_list,
                         qc.measure(qc.qubits[2 * n:],qc.clbits[:])
                         
                         # execute the program and derive the outputs
-                        dict_counts = circuit_execution(qc, default_shots)
+                        dict_counts = circuit_execution(qc, default_shots, device)
                     
                         # obtain the samples (measurement results) of the tested program
-                        test_samps = []
-                        for (key, value) in dict_counts.items():
-                            test_samps += [key] * value
+                        test_samps[row] = counts_to_samples(dict_counts)
 
                         # generate the samples that follow the expected probability distribution
-                        exp_probs = MSTC_specification(covered_numbers, n, A, b, c, num_out, pure_states_distribution)
-                        exp_samps = list(np.random.choice(range(2 ** qc.num_clbits), size=default_shots, p=exp_probs))
-                                         
-                        # derive the test result by nonparametric hypothesis test
-                        test_result = OPO_UTest(exp_samps, test_samps)
-                            
-                        if test_result == 'fail':
-                            total_failures += 1
+                        exp_probs = exp_probs_dict[(c, A_index, b_index)]
+                        exp_samps[row] = rng.choice(num_outputs, size=default_shots, p=exp_probs)
+                        row += 1
                                 
                         test_cases += 1
+
+        # derive the test results of all the test cases by nonparametric hypothesis tests
+        test_results = OPO_UTest_batch(exp_samps, test_samps)
+        total_failures = np.count_nonzero(test_results == 'fail')
                 
         recorded_result.append([n, test_cases, total_failures / test_cases / repeats])
 
@@ -167,11 +198,22 @@ def testing_process_MSTCs(program_version, n_list, matA_dict, vecB_dict, c_list,
         writer = csv.writer(file)
         header = ['n','# test_cases', 'ave_fault']
         writer.writerow(header)
-        for data in recorded_result:
-            writer.writerow(data)
+        writer.writerows(recorded_result)
     print('MSTCs done!')
 
  
+def run_one_version(program_version, n_list, matA_dict, vecB_dict, C_list, device='CPU'):
+    '''
+        test one program version with both PSTCs and MSTCs, which save their own results
+
+        Input variable:
+            + program_version    [str] e.g. "v1", "v2", "v3"
+            + device             [str] the device for the simulation, which is either 'CPU' or 'GPU'
+    '''
+    print(program_version)
+    testing_process_PSTCs(program_version, n_list, matA_dict, vecB_dict, C_list, device=device)
+    testing_process_MSTCs(program_version, n_list, matA_dict, vecB_dict, C_list, device=device)
+
 if __name__ == '__main__':
     # the setting to generate classical inputs
     n_list = range(2, 6)
@@ -204,9 +246,11 @@ if __name__ == '__main__':
         5: [[1, 1, 1, 1, 1], [-1, 2, 0, 1, 0],  [0, 0, 1, 2, 1], [1, 1, -1, -1, 0], [0, 0, 0, 1, 0]],
     }
     C_list = np.arange(-2, 3, 1)
+    # the device for the simulation, which is either 'CPU' or 'GPU'
+    device = 'CPU'
 
-    # the test processes
-    for program_version in ['v1', 'v2', 'v3', 'v4', 'v5']:
-        print(program_version)
-        testing_process_PSTCs(program_version, n_list, matA_dict, vecB_dict, C_list)
-        testing_process_MSTCs(program_version, n_list, matA_dict, vecB_dict, C_list)
\ No newline at end of file
+    # the test processes, where the program versions are independent and thus tested in parallel
+    versions = ['v1', 'v2', 'v3', 'v4', 'v5']
+    with process_pool(len(versions)) as executor:
+        list(executor.map(functools.partial(run_one_version, n_list=n_list, matA_dict=matA_dict, 
+                                            vecB_dict=vecB_dict, C_list=C_list, device=device), versions))
\ No newline at end of file
@@ -11,16 +11,25 @@ def PSTC_specification(x, A, b, c, outQubits):
     expProb[expRes] = 1 
     return expProb
 
+def PSTC_specification_batch(xs, A, b, c, outQubits):
+    # each row of xs is an initial state as in PSTC_specification, and 
+    # each row of the returned array is the expected distribution of that state
+    xs = np.asarray(xs, dtype=np.int64)
+    A = np.asarray(A, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    Q = np.sum(np.dot(xs, A) * xs, axis=1) + np.dot(xs, b) + c
+    expRes = (Q + (2 ** outQubits)) % (2 ** outQubits)
+    expProbs = np.eye(2 ** outQubits)[expRes]
+    return expProbs
+
 def MSTC_specification(inputNumbers,n, A, b, c, outQubits, inputProbs):
-    expProbs = (np.zeros(2 ** outQubits)).tolist()
-    for decimal_number in inputNumbers:
-        binary_string = bin(decimal_number)[2:].zfill(n)
-        binary_list = [int(bit) for bit in binary_string]
-        x = binary_list[::-1]
-        x = np.array(x)
-        A = np.array(A)
-        b = np.array(b)
-        Q = np.dot(np.dot(x.T, A), x) + np.dot(x.T, b) + c
-        expRes = int((Q + (2 ** outQubits)) % (2 ** outQubits))    
-        expProbs[expRes] +=  inputProbs[decimal_number]
-    return expProbs
\ No newline at end of file
+    # all the covered numbers are computed at once, where each row of x is 
+    # the reversed binary list of a number, i.e., x[:, i] is the i-th bit
+    inputNumbers = np.asarray(inputNumbers)
+    x = (inputNumbers[:, None] >> np.arange(n)) & 1
+    A = np.array(A)
+    b = np.array(b)
+    Q = np.sum(np.dot(x, A) * x, axis=1) + np.dot(x, b) + c
+    expRes = ((Q + (2 ** outQubits)) % (2 ** outQubits)).astype(int)
+    expProbs = np.bincount(expRes, weights=np.asarray(inputProbs)[inputNumbers], minlength=2 ** outQubits)
+    return expProbs.tolist()
\ No newline at end of file
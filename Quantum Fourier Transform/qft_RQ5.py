@@ -1,15 +1,15 @@
 import numpy as np
-import csv
 
 import time
+import functools
 
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_convertion import generate_numbers
+from data_convertion import generate_numbers, counts_to_histogram
 from qft_specification import PSTC_specification, MSTC_specification
-from test_oracle import OPO_UTest
-from circuit_execution import circuit_execution
+from test_oracle import OPO_UTest_from_counts_batch
+from circuit_execution import circuit_execution_batch, circuit_probabilities_batch, get_backend
 from preparation_circuits import *
 from repeat_until_success import *
 
@@ -41,9 +41,68 @@ def version_selection(program_name, program_version):
         return func
     else:
         return f"Function '{function_name}' not found."
+
+@functools.lru_cache(maxsize=None)
+def transpiled_subroutine(func, n, if_swap):
+    '''
+        build and transpile the tested subroutine only once for each setting
+
+        Input variable:
+            + func               [function] the selected program version, e.g. QFT_defect1
+            + n                  [int] the number of qubits
+            + if_swap            [bool] whether the swaps are applied at the end
+        
+        Output variable:
+            + qc_test            [QuantumCircuit] the transpiled subroutine, which should be composed 
+                                 into (rather than modified by) the test circuits
+    '''
+    qc_test = func(num_qubits=n, do_swaps=if_swap)
+    return transpile(qc_test, get_backend(), optimization_level=0)
+
+@functools.lru_cache(maxsize=None)
+def cached_PSTC_specification(n, number, if_swap):
+    '''
+        compute the expected probability distribution of a PSTC only once for each setting, 
+        which is shared as a read-only array
+
+        Input variable:
+            + n                  [int] the number of qubits
+            + number             [int] the classical input
+            + if_swap            [bool] whether the swaps are applied at the end
+    '''
+    exp_probs = np.asarray(PSTC_specification(n, number, if_swap))
+    exp_probs.setflags(write=False)
+    return exp_probs
+
+@functools.lru_cache(maxsize=None)
+def cached_MSTC_specification(numbers, input_probs, n, if_swap):
+    '''
+        compute the expected probability distribution of an MSTC only once for each setting, 
+        which is shared as a read-only array
+
+        Input variable:
+            + numbers            [tuple] the covered classical inputs
+            + input_probs        [tuple] the probability distribution of input pure states
+            + n                  [int] the number of qubits
+            + if_swap            [bool] whether the swaps are applied at the end
+    '''
+    exp_probs = np.asarray(MSTC_specification(np.asarray(numbers), input_probs, n, if_swap))
+    exp_probs.setflags(write=False)
+    return exp_probs
+
+def save_recorded_result(file_name, recorded_result):
+    '''
+        save the recorded results of a testing process by a single formatting pass
+
+        Input variable:
+            + file_name          [str] the name of the csv file
+            + recorded_result    [array] each row gives [shots, ave_time, ave_fault]
+    '''
+    np.savetxt(file_name, recorded_result, fmt=('%d', '%s', '%s'), delimiter=',', 
+               header='shots,ave_time,ave_fault', comments='')
         
 def testing_process_MSTCs_1MS(program_version, if_swap_list, inputs_list, 
-                              mixed_pre_mode, shots_list, repeats=20):
+                              mixed_pre_mode, shots_list, repeats=20, seed=None):
     """
         Cover a group of classical inputs with only one mixed state. For example, n = 2,
         rho = 1/4 * (|0><0| + |1><1| + |2><2| + |3><3|)
@@ -57,81 +116,74 @@ def testing_process_MSTCs_1MS(program_version, if_swap_list, inputs_list,
                                    input_probs -- the probability distribution of input pure states
                                    input_name -- the name of the test suite
             + mixed_pre_mode [str]: the mode for preparing mixed states, which is either 'ent' or 'sep'
+            + seed [int]: the seed of the random generator for sampling the expected distributions
 
         Output variable:
-            + recorded_result [list]: each element gives [input_name, test_cases, ave_time]  
+            + recorded_result [array]: each row gives [shots, ave_time, ave_fault]  
     """
 
     program_name = 'QFT'
-    recorded_result = []      
+    func = version_selection(program_name, program_version)
+    # the shape of the results is known in advance, and thus the array is preallocated
+    recorded_result = np.empty((len(shots_list), 3))
+    rng = np.random.default_rng(seed)
+    
+    n, m, angle_list, pure_states_distribution = inputs_list[0], inputs_list[1], inputs_list[2], inputs_list[3]
+    # cover all the classical states            
+    covered_numbers = np.arange(1 << n, dtype=np.int64)
+    # the expected probability distributions are computed only once for all the shots and repeats
+    exp_probs_dict = {if_swap: cached_MSTC_specification(tuple(covered_numbers), tuple(pure_states_distribution), n, if_swap) 
+                      for if_swap in if_swap_list}
+    num_classical_inputs = len(if_swap_list)
+
+    # the test circuits do not change over the shots and repeats, and thus are built and transpiled only once
+    executedQCs = {}
+    for if_swap in if_swap_list:
+        qc = QuantumCircuit(n + m, n)
+
+        # prepare the control states and the mixed state
+        qc_pre = mixed_state_preparation(n, m, tuple(angle_list), mixed_pre_mode, '1MS')
+        qc.compose(qc_pre, qc.qubits, qc.clbits[-1:], inplace=True)
+            
+        # append the tested quantum subroutine (quantum program) 
+        qc_test = transpiled_subroutine(func, n, if_swap)
+        qc.compose(qc_test, qc.qubits[m:], inplace=True)
+        qc.measure(qc.qubits[m:],qc.clbits[:])
+        executedQCs[if_swap] = transpile(qc, get_backend(), optimization_level=0)
     
-    for shots in shots_list:
-        n, m, angle_list, pure_states_distribution = inputs_list[0], inputs_list[1], inputs_list[2], inputs_list[3]
-        # cover all the classical states            
-        covered_numbers = list(range(2 ** n))
-        total_failures = 0
-        num_classical_inputs = len(if_swap_list)
+    # the test cases and their expected distributions do not depend on the shots, and thus are 
+    # listed only once, where the repeats of each test case are adjacent
+    cases = [if_swap for if_swap in if_swap_list for _ in range(repeats)]
+    test_cases = len(if_swap_list)
+    qc_list = [executedQCs[case] for case in cases]
+    exp_probs_array = np.stack([exp_probs_dict[case] for case in cases])
+
+    for index, shots in enumerate(shots_list):
         start_time = time.time()
-        for _ in range(repeats):
-            test_cases = 0
-            for if_swap in if_swap_list:
-                test_cases += 1
-                qc = QuantumCircuit(n + m, n)
-
-                con_pre_mode = 'sep' if m == len(angle_list) else 'ent'
-                if con_pre_mode == 'sep':
-                    qc_con = separable_control_state_preparation(angle_list)
-                elif con_pre_mode == 'ent':
-                    qc_con = entangled_control_state_preparation(angle_list)
-                
-                qc.append(qc_con, qc.qubits[:m])
-
-                if mixed_pre_mode == 'bits':
-                    qc = bit_controlled_preparation_1MS(n, m, qc)
-                elif mixed_pre_mode == 'qubits':
-                    qc = qubit_controlled_preparation_1MS(n, m, qc) 
-                    
-                # append the tested quantum subroutine (quantum program) 
-                func = version_selection(program_name, program_version)
-                qc_test = func(num_qubits=n, do_swaps=if_swap)
-                qc.append(qc_test, qc.qubits[m:])
-                qc.measure(qc.qubits[m:],qc.clbits[:])
-                
-                # execute the program and derive the outputs
-                dict_counts = circuit_execution(qc, shots)
+        # execute the programs of all the repeats and test cases in a single job
+        dict_counts_list = circuit_execution_batch(qc_list, shots)
 
-                # obtain the samples (measurement results) of the tested program
-                test_samps = []
-                for (key, value) in dict_counts.items():
-                    test_samps += [key] * value
-                
-                # generate the samples that follow the expected probability distribution
-                exp_probs = MSTC_specification(covered_numbers, pure_states_distribution, n, if_swap)
-                exp_samps = list(np.random.choice(range(2 ** qc.num_clbits), size=shots, p=exp_probs))
-
-                # derive the test result by nonparametric hypothesis test
-                test_result = OPO_UTest(exp_samps, test_samps)
-                        
-                if test_result == 'fail':
-                    total_failures += 1
+        # obtain the counts of each output of the tested programs
+        test_counts_array = np.stack([counts_to_histogram(dict_counts, 2 ** n) for dict_counts in dict_counts_list])
+
+        # derive the test results of all the test cases by U tests on the counts, where the 
+        # expected counts of all the repeats and test cases are drawn at once
+        exp_counts_array = rng.multinomial(shots, exp_probs_array)
+        test_results = OPO_UTest_from_counts_batch(exp_counts_array, test_counts_array)
+        total_failures = np.count_nonzero(test_results == 'fail')
         
         dura_time = time.time() - start_time                           
-        recorded_result.append([shots,
-                                dura_time / num_classical_inputs / repeats, 
-                                total_failures / test_cases / repeats])
+        recorded_result[index] = (shots,
+                                  dura_time / num_classical_inputs / repeats, 
+                                  total_failures / test_cases / repeats)
         
     file_name = "RQ5_" + program_name + '_' + program_version + '_' + "MSTC(1MS)" + ".csv"
-    with open(file_name, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        header = ['shots', 'ave_time', 'ave_fault']
-        writer.writerow(header)
-        for data in recorded_result:
-            writer.writerow(data)
+    save_recorded_result(file_name, recorded_result)
     print('MSTCs(1MS) done!')
 
 
 def testing_process_MSTCs_2MS(program_version, if_swap_list, inputs_list, 
-                              mixed_pre_mode, shots_list, repeats=20):
+                              mixed_pre_mode, shots_list, repeats=20, seed=None):
     """
         Cover a group of classical inputs with two mixed state. Given n,
         rho1 = 1/(2^(n-1)) * (|0><0| + ... + |2^{n-1}-1><2^{n-1}-1|) 
@@ -150,149 +202,163 @@ def testing_process_MSTCs_2MS(program_version, if_swap_list, inputs_list,
                                    pure_states_distributionss -- 2 probability distributions of input pure states
                                    input_name -- the name of the test suite
             + mixed_pre_mode [str]: the mode for preparing mixed states, which is either 'ent' or 'sep'
+            + seed [int]: the seed of the random generator for sampling the expected distributions
 
         Output variable:
-            + recorded_result [list]: each element gives [input_name, test_cases, ave_time]  
+            + recorded_result [array]: each row gives [shots, ave_time, ave_fault]  
     """  
 
     program_name = 'QFT'
-    recorded_result = []      
+    func = version_selection(program_name, program_version)
+    # the shape of the results is known in advance, and thus the array is preallocated
+    recorded_result = np.empty((len(shots_list), 3))
     MSB_val_list = [0, 1]
+    rng = np.random.default_rng(seed)
+
+    n, m, angle_lists, pure_states_distributions = inputs_list[0], inputs_list[1], inputs_list[2], inputs_list[3] 
+    # cover all the classical states            
+    covered_numbers = np.arange(1 << n, dtype=np.int64)
+    # the expected probability distributions are computed only once for all the shots and repeats
+    exp_probs_dict = {(if_swap, MSB_val): cached_MSTC_specification(tuple(covered_numbers), tuple(pure_states_distributions[MSB_val]), n, if_swap) 
+                      for if_swap in if_swap_list for MSB_val in MSB_val_list}
+    num_classical_inputs = len(if_swap_list)
+
+    # the test circuits do not change over the shots and repeats, and thus are built and transpiled only once
+    executedQCs = {}
+    for if_swap in if_swap_list:
+        for MSB_val in MSB_val_list:
+            angle_list = angle_lists[MSB_val]
+
+            qc = QuantumCircuit(n + m, n)
+            
+            # prepare the most significant qubit, the control states and the mixed state
+            qc_pre = mixed_state_preparation(n, m, tuple(angle_list), mixed_pre_mode, '2MS', MSB_val)
+            qc.compose(qc_pre, qc.qubits, qc.clbits[-1:], inplace=True)
+                
+            # append the tested quantum subroutine (quantum program) 
+            qc_test = transpiled_subroutine(func, n, if_swap)
+            qc.compose(qc_test, qc.qubits[m:], inplace=True)
+            qc.measure(qc.qubits[m:],qc.clbits[:])
+            executedQCs[(if_swap, MSB_val)] = transpile(qc, get_backend(), optimization_level=0)
+
+    # the test cases and their expected distributions do not depend on the shots, and thus are 
+    # listed only once, where the repeats of each test case are adjacent
+    cases = [(if_swap, MSB_val) for if_swap in if_swap_list for MSB_val in MSB_val_list 
+             for _ in range(repeats)]
+    test_cases = len(if_swap_list) * len(MSB_val_list)
+    qc_list = [executedQCs[case] for case in cases]
+    exp_probs_array = np.stack([exp_probs_dict[case] for case in cases])
 
-    for shots in shots_list:
-        n, m, angle_lists, pure_states_distributions = inputs_list[0], inputs_list[1], inputs_list[2], inputs_list[3] 
-        # cover all the classical states            
-        covered_numbers = list(range(2 ** n))
-        total_failures = 0
-        num_classical_inputs = len(if_swap_list)
+    for index, shots in enumerate(shots_list):
         start_time = time.time()
-        for _ in range(repeats):
-            test_cases = 0
-            for if_swap in if_swap_list:
-                for MSB_val in MSB_val_list:
-                    test_cases += 1
-                    angle_list = angle_lists[MSB_val]
-                    pure_states_distribution = pure_states_distributions[MSB_val]
-
-                    qc = QuantumCircuit(n + m, n)
-                    
-                    # prepare the most significant qubit
-                    if MSB_val == 1:
-                        qc.x(m + n - 1)
-
-                    con_pre_mode = 'sep' if m == len(angle_list) else 'ent'
-                    if con_pre_mode == 'sep':
-                        qc_con = separable_control_state_preparation(angle_list)
-                    elif con_pre_mode == 'ent':
-                        qc_con = entangled_control_state_preparation(angle_list)
-                    
-                    qc.append(qc_con, qc.qubits[:m])
-
-                    if mixed_pre_mode == 'bits':
-                        qc = bit_controlled_preparation_2MS(n, m, qc)
-                    elif mixed_pre_mode == 'qubits':
-                        qc = qubit_controlled_preparation_2MS(n, m, qc) 
-                        
-                    # append the tested quantum subroutine (quantum program) 
-                    func = version_selection(program_name, program_version)
-                    qc_test = func(num_qubits=n, do_swaps=if_swap)
-                    qc.append(qc_test, qc.qubits[m:])
-                    qc.measure(qc.qubits[m:],qc.clbits[:])
-                    
-                    # execute the program and derive the outputs
-                    dict_counts = circuit_execution(qc, shots)
-
-                    # obtain the samples (measurement results) of the tested program
-                    test_samps = []
-                    for (key, value) in dict_counts.items():
-                        test_samps += [key] * value
-                    
-                    # generate the samples that follow the expected probability distribution
-                    exp_probs = MSTC_specification(covered_numbers, pure_states_distribution, n, if_swap)
-                    exp_samps = list(np.random.choice(range(2 ** qc.num_clbits), size=shots, p=exp_probs))
-
-                    # derive the test result by nonparametric hypothesis test
-                    test_result = OPO_UTest(exp_samps, test_samps)
-                            
-                    if test_result == 'fail':
-                        total_failures += 1
+        # execute the programs of all the repeats and test cases in a single job
+        dict_counts_list = circuit_execution_batch(qc_list, shots)
+
+        # obtain the counts of each output of the tested programs
+        test_counts_array = np.stack([counts_to_histogram(dict_counts, 2 ** n) for dict_counts in dict_counts_list])
+
+        # derive the test results of all the test cases by U tests on the counts, where the 
+        # expected counts of all the repeats and test cases are drawn at once
+        exp_counts_array = rng.multinomial(shots, exp_probs_array)
+        test_results = OPO_UTest_from_counts_batch(exp_counts_array, test_counts_array)
+        total_failures = np.count_nonzero(test_results == 'fail')
                             
         dura_time = time.time() - start_time                           
-        recorded_result.append([shots,
-                                dura_time / num_classical_inputs / repeats, 
-                                total_failures / test_cases / repeats])
+        recorded_result[index] = (shots,
+                                  dura_time / num_classical_inputs / repeats, 
+                                  total_failures / test_cases / repeats)
         
     file_name = "RQ5_" + program_name + '_' + program_version + '_' + "MSTC(2MS)" + ".csv"
-    with open(file_name, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        header = ['shots', 'ave_time', 'ave_fault']
-        writer.writerow(header)
-        for data in recorded_result:
-            writer.writerow(data)
+    save_recorded_result(file_name, recorded_result)
     print('MSTCs(1MS) done!')
 
-def testing_process_PSTCs(program_version, n, if_swap_list, shots_list, repeats=20):
+def testing_process_PSTCs(program_version, n, if_swap_list, shots_list, repeats=20, seed=None):
     program_name = 'QFT'
+    func = version_selection(program_name, program_version)
     candidate_initial_states = [0, 1]
+    rng = np.random.default_rng(seed)
+
+    # all the initial states as a (2^n, n) matrix of qubit values, together with the qubits 
+    # flipped by X gates for each of them (the states are reversed to the qubit order)
+    initial_states_array = np.asarray(candidate_initial_states, dtype=np.int8)[
+        generate_numbers(n, len(candidate_initial_states))]
+    x_indices_list = [np.flatnonzero(initial_states) for initial_states in initial_states_array[:, ::-1]]
+    # the classical input of each initial state, where the first digit is the most significant bit
+    weights = 1 << np.arange(n - 1, -1, -1)
+    numbers = np.dot(initial_states_array.astype(np.int64), weights).tolist()
     
-    recorded_result = []     
-    for shots in shots_list: 
-        total_failures = 0
+    # the expected probability distributions are computed only once for all the shots and repeats
+    exp_probs_dict = {(if_swap, number): cached_PSTC_specification(n, number, if_swap) 
+                      for if_swap in if_swap_list for number in range(2 ** n)}
+    num_classical_inputs = len(if_swap_list)
+
+    # the test circuits do not change over the shots and repeats, and thus are built only once, where 
+    # the X gates and the transpiled subroutine are already supported by the backend
+    # the tested quantum subroutine (quantum program) and the measurements are shared by all the 
+    # initial states, so that a template is built for each if_swap
+    templates = {}
+    for if_swap in if_swap_list:
+        template = QuantumCircuit(n)
+        qc_test = transpiled_subroutine(func, n, if_swap)
+        template.compose(qc_test, template.qubits, inplace=True)
+        templates[if_swap] = template
+
+    executedQCs = {}
+    for if_swap in if_swap_list:
+        for number, x_indices in zip(numbers, x_indices_list):
+            qc = templates[if_swap].copy_empty_like()
+            # the initial states are really prepared by X gates, rather than derived by XOR-ing the 
+            # outputs of the single input |0>: the relabeled outputs only hold for the raw QFT, whose 
+            # output distribution is uniform for every basis state, but not for the defective versions 
+            # under test, so that the relabeling would hide their faults
+            # the X gates of all the flipped qubits are appended by a single call
+            if len(x_indices):
+                qc.x(x_indices.tolist())
+            qc.compose(templates[if_swap], inplace=True)
+            executedQCs[(if_swap, number)] = qc
+
+    # the PSTCs include no mid-circuit measurements, so that the output distribution of each test 
+    # circuit is derived exactly from its statevector only once, and the measurement results of 
+    # every shots and repeat are then sampled from it rather than simulated again
+    pre_start_time = time.time()
+    keys = list(executedQCs.keys())
+    probs_list = circuit_probabilities_batch([executedQCs[key] for key in keys])
+    test_probs_dict = dict(zip(keys, probs_list))
+    # the U test is not skipped for the PSTCs whose exact output distribution equals the expected 
+    # one: the QFT of any basis state is uniform over all the outputs, so that the sampled U test 
+    # of a correct PSTC still fails at about the significance level, which belongs to the results
+
+    # the test cases are ordered by if_swap, initial state and repeat, and the actual and expected 
+    # distributions of all of them are stacked only once, so that each shots only draws the counts
+    cases = [(if_swap, number) for if_swap in if_swap_list for number in numbers 
+             for _ in range(repeats)]
+    test_cases = len(if_swap_list) * len(numbers)
+    test_probs_array = np.stack([test_probs_dict[case] for case in cases])
+    exp_probs_array = np.stack([exp_probs_dict[case] for case in cases])
+    # the one-off simulation is needed by the testing with any shots, and thus is added to the 
+    # time of each shots
+    pre_time = time.time() - pre_start_time
+    
+    # the shape of the results is known in advance, and thus the array is preallocated
+    recorded_result = np.empty((len(shots_list), 3))
+    for index, shots in enumerate(shots_list):
         start_time = time.time()
-        num_classical_inputs = len(if_swap_list)
-        for _ in range(repeats):
-            initial_states_list = generate_numbers(n, len(candidate_initial_states))
-            test_cases = 0
-            for if_swap in if_swap_list:
-                for initial_states in initial_states_list:
-                    test_cases += 1
-                    number = int(''.join(map(str, initial_states)), 2)
-                    qc = QuantumCircuit(n, n)
-                    initial_states = initial_states[::-1]
-                    for index, val in enumerate(initial_states):
-                        if candidate_initial_states[val] == 1:
-                            qc.x(index)
-                                        
-                    # append the tested quantum subroutine (quantum program) 
-                    func = version_selection(program_name, program_version)
-                    qc_test = func(num_qubits=n, do_swaps=if_swap)
-                    qc.append(qc_test, qc.qubits)
-                    qc.measure(qc.qubits[:],qc.clbits[:])
-                        
-                    # execute the program and derive the outputs
-                    backend = Aer.get_backend('qasm_simulator')
-                    executedQC = transpile(qc, backend)
-                    count= backend.run(executedQC, shots=shots).result().get_counts()
-                    dict_counts = count.int_outcomes()
-
-                    # obtain the samples (measurement results) of the tested program
-                    test_samps = []
-                    for (key, value) in dict_counts.items():
-                        test_samps += [key] * value
-                    
-                    # generate the samples that follow the expected probability distribution
-                    exp_probs = PSTC_specification(n, number, if_swap)
-                    exp_samps = list(np.random.choice(range(2 ** qc.num_clbits), size=shots, p=exp_probs))
-
-                    # derive the test result by nonparametric hypothesis test
-                    test_result = OPO_UTest(exp_samps, test_samps)
-
-                    if test_result == 'fail':
-                        total_failures += 1    
+        # sample the measurement results and the expected counts of all the repeats and test cases at once
+        test_counts_array = rng.multinomial(shots, test_probs_array)
+        exp_counts_array = rng.multinomial(shots, exp_probs_array)
 
-        dura_time = time.time() - start_time                           
-        recorded_result.append([shots,
-                                dura_time / num_classical_inputs / repeats, 
-                                total_failures / test_cases / repeats])
+        # derive the test results of all the test cases by U tests on the counts
+        test_results = OPO_UTest_from_counts_batch(exp_counts_array, test_counts_array)
+        total_failures = np.count_nonzero(test_results == 'fail')
+
+        dura_time = time.time() - start_time + pre_time                          
+        recorded_result[index] = (shots,
+                                  dura_time / num_classical_inputs / repeats, 
+                                  total_failures / test_cases / repeats)
   
     # save the data
     file_name = "RQ5_" + program_name + '_' + program_version + "_PSTC" + ".csv"
-    with open(file_name, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        header = ['shots', 'ave_time', 'ave_fault']
-        writer.writerow(header)
-        for data in recorded_result:
-            writer.writerow(data)
+    save_recorded_result(file_name, recorded_result)
     print('PSTCs done!')    
 
  
@@ -16,9 +16,17 @@ def PSTC_specification(n, number, if_swap):
     return exp_probs
 
 def MSTC_specification(numbers, input_probs, n, if_swap):
-    exp_probs = np.array([0] * (2 ** n))
-    for number in numbers:
-        cond_probs = PSTC_specification(n, number, if_swap)
-        add_probs = np.array(cond_probs) * input_probs[number]
-        exp_probs = exp_probs + add_probs
+    # the state vectors of all the numbers are built at once, one row per number
+    numbers = np.asarray(numbers)
+    for index in range(n):
+        theta = 2 * math.pi * numbers / (2 ** (index + 1))
+        tempVecs = 1 / math.sqrt(2) * np.stack([np.ones(len(numbers)), np.exp(theta * 1j)], axis=1)
+        if index == 0:
+            stateVecs = tempVecs
+        else:
+            if if_swap:
+                stateVecs = (stateVecs[:, :, None] * tempVecs[:, None, :]).reshape(len(numbers), -1)
+            else:
+                stateVecs = (tempVecs[:, :, None] * stateVecs[:, None, :]).reshape(len(numbers), -1)
+    exp_probs = np.dot(np.asarray(input_probs)[numbers], abs(stateVecs) ** 2)
     return exp_probs
\ No newline at end of file
@@ -1,12 +1,90 @@
+import os
+import functools
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from qiskit import transpile
-from qiskit_aer import Aer
+from qiskit_aer import Aer, AerSimulator
 
-def circuit_execution(qc, shots):
+# the number of threads of each simulator in this process, where 0 means all the CPUs
+max_parallel_threads = 0
+
+def limit_threads(num_threads):
+    """
+        Limit the threads of the simulators in this process, so that the simulators of parallel 
+        processes share the CPUs rather than oversubscribe them.
+    """
+    global max_parallel_threads
+    max_parallel_threads = num_threads
+    get_backend.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def get_backend(device='CPU', method=None):
+    """
+        Return the simulator backend on the given device ('CPU' or 'GPU') with the given simulation 
+        method, where None selects the default one. On a GPU, the statevector simulator executes the 
+        shots of a circuit in batches. If no GPU is available, a warning is given and the CPU 
+        simulator is used instead. The threads of the simulator follow limit_threads.
+    """
+    if device == 'GPU':
+        if 'GPU' in AerSimulator().available_devices():
+            return AerSimulator(method=method or 'statevector', device='GPU', batched_shots_gpu=True, 
+                                batched_shots_gpu_max_qubits=16, max_parallel_threads=max_parallel_threads)
+        warnings.warn("No GPU is available for Aer, and thus the CPU simulator is used instead.")
+    if method is None:
+        backend = Aer.get_backend('qasm_simulator')
+        backend.set_options(max_parallel_threads=max_parallel_threads)
+        return backend
+    return AerSimulator(method=method, max_parallel_threads=max_parallel_threads)
+
+def circuit_execution(qc, shots, device='CPU'):
     """
         Execute the quantum circuit with given shots, and then return the measurement results.
     """
-    backend = Aer.get_backend('qasm_simulator')
-    executedQC = transpile(qc, backend)
+    backend = get_backend(device)
+    # the circuits are small and simulated, so only the basis translation is needed
+    executedQC = transpile(qc, backend, optimization_level=0)
     count= backend.run(executedQC, shots=shots).result().get_counts()
     dict_counts = count.int_outcomes()
-    return dict_counts
\ No newline at end of file
+    return dict_counts
+
+def circuit_execution_batch(qc_list, shots, parameter_binds=None, device='CPU'):
+    """
+        Execute a list of quantum circuits with given shots in a single job, and then return the 
+        measurement results of each experiment in order. The circuits should have been transpiled.
+
+        If parameter_binds is given, it includes one dictionary {parameter: [values]} for each 
+        circuit, and the circuit is executed once for each of the bound values.
+    """
+    backend = get_backend(device)
+    result = backend.run(qc_list, shots=shots, parameter_binds=parameter_binds).result()
+    dict_counts_list = [result.get_counts(i).int_outcomes() for i in range(len(result.results))]
+    return dict_counts_list
+
+def circuit_probabilities_batch(qc_list, device='CPU'):
+    """
+        Simulate a list of quantum circuits without measurements by the statevector simulator in a 
+        single job, and then return the exact probabilities of all the basis states of each circuit 
+        in order, so that any number of shots can be sampled from them afterwards.
+    """
+    backend = get_backend(device, 'statevector')
+    saved_qc_list = []
+    for qc in qc_list:
+        saved_qc = qc.copy()
+        saved_qc.save_statevector()
+        saved_qc_list.append(saved_qc)
+    result = backend.run(saved_qc_list, shots=1).result()
+    probs_list = [result.get_statevector(i).probabilities() for i in range(len(saved_qc_list))]
+    return probs_list
+
+def process_pool(num_tasks):
+    """
+        Return a process pool for running independent tasks (e.g., program versions) in parallel, 
+        with one process per task up to the number of CPUs. The processes are spawned rather than 
+        forked, since forking a process that already runs Aer threads is unsafe. The CPUs are split 
+        evenly among the processes, since each simulator uses all of them by default, and the shots 
+        and experiments of a job are parallelized only within these threads.
+    """
+    num_workers = min(num_tasks, os.cpu_count())
+    return ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'), 
+                               initializer=limit_threads, initargs=(max(os.cpu_count() // num_workers, 1),))
@@ -55,4 +55,39 @@ def output_prob(counts, n):
         else:
             prob_dist.append(output_dic[i]/counts.shots())
     prob_dist = np.asarray(prob_dist) / np.sum(prob_dist)
-    return prob_dist
\ No newline at end of file
+    return prob_dist
+
+def counts_to_samples(dict_counts):
+
+    """
+        The dictionary of measurement results is expanded into the corresponding samples
+
+        Input variable:
+            + dict_counts  [dict]    the measurement results, e.g. {0: 2, 3: 1}
+
+        Output variable:
+            + samps        [array]   the samples of measurement results, e.g. [0, 0, 3]
+    """
+
+    keys = np.fromiter(dict_counts.keys(), dtype=np.int64, count=len(dict_counts))
+    values = np.fromiter(dict_counts.values(), dtype=np.int64, count=len(dict_counts))
+    samps = np.repeat(keys, values)
+    return samps
+
+def counts_to_histogram(dict_counts, num_outputs):
+
+    """
+        The dictionary of measurement results is transformed into the counts of all the outputs
+
+        Input variables:
+            + dict_counts  [dict]    the measurement results, e.g. {0: 2, 3: 1}
+            + num_outputs  [int]     the number of possible outputs, e.g. 4
+
+        Output variable:
+            + hist         [array]   the counts of each output, e.g. [2, 0, 0, 1]
+    """
+
+    hist = np.zeros(num_outputs, dtype=np.int64)
+    keys = np.fromiter(dict_counts.keys(), dtype=np.int64, count=len(dict_counts))
+    hist[keys] = np.fromiter(dict_counts.values(), dtype=np.int64, count=len(dict_counts))
+    return hist
\ No newline at end of file
@@ -1,4 +1,5 @@
 import math
+import functools
 from qiskit.circuit import QuantumCircuit
 from qiskit.circuit.library import RYGate 
 from qiskit import QuantumCircuit, transpile
@@ -353,4 +354,51 @@ def qubit_controlled_preparation_MPS(n, m, qc):
         qc.cx(qc.qubits[index - m], qc.qubits[index])
     for i in range(m):
         qc.measure(qc.qubits[i], qc.clbits[i])
+    return qc
+
+@functools.lru_cache(maxsize=None)
+def mixed_state_preparation(n, m, angle_list, mixed_pre_mode, cover_mode, MSB_val=0):
+    """
+        Build the preparation of control states and mixed states only once for each setting, where
+        the returned circuit is shared and should be composed into (rather than modified by) the 
+        test circuits.
+
+        Input variable: 
+            + n:                [int]               the number of target qubits
+            + m:                [int]               the number of control qubits
+            + angle_list:       [tuple]             the thetas for preparing control states, which is
+                                                    a tuple so that the setting can be cached
+            + mixed_pre_mode:   [str]               either 'bits' or 'qubits'
+            + cover_mode:       [str]               either '1MS' or '2MS'
+            + MSB_val:          [int]               the value of the most significant target qubit, 
+                                                    which is flipped in advance if it is 1
+        Output variable:
+            + qc:   [QuantumCircuit]    the circuit on n + m qubits and one classical bit
+
+        Running example:
+            qc = QuantumCircuit(n + m + 1, 1)
+            qc_pre = mixed_state_preparation(n, m, tuple(angle_list), 'qubits', '1MS')
+            qc.compose(qc_pre, qc.qubits[:n + m], qc.clbits[-1:], inplace=True)
+    """
+    qc = QuantumCircuit(n + m, 1)
+
+    # prepare the most significant qubit
+    if MSB_val == 1:
+        qc.x(m + n - 1)
+
+    con_pre_mode = 'sep' if m == len(angle_list) else 'ent'
+    if con_pre_mode == 'sep':
+        qc_con = separable_control_state_preparation(list(angle_list))
+    elif con_pre_mode == 'ent':
+        qc_con = entangled_control_state_preparation(list(angle_list))
+    
+    qc.append(qc_con, qc.qubits[:m])
+
+    preparation_dict = {
+        ('bits', '1MS'): bit_controlled_preparation_1MS,
+        ('qubits', '1MS'): qubit_controlled_preparation_1MS,
+        ('bits', '2MS'): bit_controlled_preparation_2MS,
+        ('qubits', '2MS'): qubit_controlled_preparation_2MS
+    }
+    qc = preparation_dict[(mixed_pre_mode, cover_mode)](n, m, qc)
     return qc
\ No newline at end of file
@@ -1,4 +1,5 @@
-from scipy.stats import mannwhitneyu
+import numpy as np
+from scipy.stats import mannwhitneyu, norm
 
 def OPO_UTest(expSamps, testSamps, threshold=0.05):
     
@@ -19,11 +20,107 @@ def OPO_UTest(expSamps, testSamps, threshold=0.05):
         Output variable: the test result ('pass' or 'fail')
     '''
     
-    expSamps = list(expSamps)
-    testSamps = list(testSamps)
+    # the samples are passed as arrays, since converting them into lists only costs time, and 
+    # mannwhitneyu ranks the arrays by vectorized sorting anyway
+    expSamps = np.asarray(expSamps)
+    testSamps = np.asarray(testSamps)
 
     _, p_value = mannwhitneyu(expSamps, testSamps)
     if p_value > threshold:
         return 'pass'
     else:
         return 'fail'
+
+def OPO_UTest_batch(expSamps, testSamps, threshold=0.05):
+
+    '''
+        This provides the test results of a batch of test cases by Mann–Whitney U tests, where 
+        the tests of all the rows are computed at once in a vectorized way
+
+        Input variables:
+            + expSamps:  [array]
+                         (num_tests, shots) array, where each row includes the samples following 
+                         the expected probability distribution of a test case
+            + testSamps: [array]
+                         (num_tests, shots) array, where each row includes the actual measurement 
+                         results of the same test case
+            + threshold: [float]
+                         the p-value that determines whether to reject the null hypothesis,
+                         where the default value is 0.05
+        
+        Output variable: the array of test results ('pass' or 'fail')
+    '''
+
+    _, p_values = mannwhitneyu(expSamps, testSamps, axis=1)
+    return np.where(p_values > threshold, 'pass', 'fail')
+
+def OPO_UTest_from_counts_batch(expCounts, testCounts, threshold=0.05):
+
+    '''
+        This provides the test results of a batch of test cases by Mann–Whitney U tests, where 
+        the tests are computed from the counts of each output, so that the samples need not be 
+        expanded, and the tests of all the rows are computed at once in a vectorized way. The 
+        midranks of the tied samples are derived by the cumulative counts, and the normal 
+        approximation with the tie and continuity corrections is applied as in mannwhitneyu
+
+        Input variables:
+            + expCounts:  [array]
+                         (num_tests, num_outputs) array, where each row includes the counts of 
+                         each output in the samples following the expected probability distribution 
+                         of a test case
+            + testCounts: [array]
+                         (num_tests, num_outputs) array, where each row includes the counts of 
+                         each output in the actual measurement results of the same test case
+            + threshold: [float]
+                         the p-value that determines whether to reject the null hypothesis,
+                         where the default value is 0.05
+        
+        Output variable: the array of test results ('pass' or 'fail')
+    '''
+
+    expCounts = np.asarray(expCounts, dtype=np.int64)
+    testCounts = np.asarray(testCounts, dtype=np.int64)
+    counts = expCounts + testCounts
+    n1, n2 = expCounts.sum(axis=1), testCounts.sum(axis=1)
+
+    midranks = np.cumsum(counts, axis=1) - (counts - 1) / 2
+    U1 = np.sum(expCounts * midranks, axis=1) - n1 * (n1 + 1) / 2
+    U = np.maximum(U1, n1 * n2 - U1)
+
+    n = n1 + n2
+    tie_term = np.sum(counts ** 3 - counts, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+        z = (U - n1 * n2 / 2 - 0.5) / s
+    p_values = np.minimum(2 * norm.sf(z), 1)
+    test_results = np.where(p_values > threshold, 'pass', 'fail')
+
+    # mannwhitneyu uses the exact distribution for small samples without ties
+    outputs = np.arange(counts.shape[1])
+    for row in np.flatnonzero((np.minimum(n1, n2) <= 8) & np.all(counts <= 1, axis=1)):
+        test_results[row] = OPO_UTest(np.repeat(outputs, expCounts[row]), 
+                                      np.repeat(outputs, testCounts[row]), threshold)
+    return test_results
+
+def OPO_UTest_from_counts(expCounts, testCounts, threshold=0.05):
+
+    '''
+        This provides the same test result as OPO_UTest from the counts of each output, which 
+        is derived by OPO_UTest_from_counts_batch with a single row
+
+        Input variables:
+            + expCounts:  [array]   
+                         the counts of each output in the samples following the expected 
+                         probability distribution of the tested quantum program
+            + testCounts: [array]
+                         the counts of each output in the actual measurement results of the 
+                         tested quantum program
+            + threshold: [float]
+                         the p-value that determines whether to reject the null hypothesis,
+                         where the default value is 0.05
+        
+        Output variable: the test result ('pass' or 'fail')
+    '''
+
+    test_results = OPO_UTest_from_counts_batch(np.asarray(expCounts)[None], np.asarray(testCounts)[None], threshold)
+    return str(test_results[0])